@@ -0,0 +1,261 @@
+import re
+import threading
+
+import duckdb
+import pandas as pd
+
+# Cube KPI embarqué : les magasins sont agrégés une seule fois par fichier source dans une base
+# DuckDB locale (département × période × métrique). Les cartes KPI, les tableaux par département
+# ou par zone et les comparaisons d'une année sur l'autre deviennent de simples lectures du cube.
+DB_PATH = "kpi_cube.duckdb"
+
+# À incrémenter à chaque changement des métriques ou des règles de détection / normalisation :
+# les sources ingérées avec une autre version sont supprimées puis réingérées.
+VERSION_CUBE = 2
+# Nombre de fichiers sources conservés dans la base (les plus anciennement ingérés sont purgés)
+NB_SOURCES_MAX = 20
+
+# Colonnes reconnues comme métriques : "CA 2023", "CA 2024", "Nb Visite", "Nb Visite 2024"...
+# Une colonne sans année vaut pour toutes les périodes (periode = "").
+METRIQUES = ["CA", "Nb Visite"]
+COMPTAGES = ["Nb Magasins", "Nb Clients"]
+REGEX_METRIQUE = re.compile(r"^(?P<metrique>%s)(?: (?P<periode>\d{4}))?$" % "|".join(map(re.escape, METRIQUES)))
+
+_connexion = None
+_verrou = threading.Lock()
+
+
+def get_connexion():
+    global _connexion
+    with _verrou:
+        if _connexion is None:
+            _connexion = duckdb.connect(DB_PATH)
+            _connexion.execute("""
+                CREATE TABLE IF NOT EXISTS cube (
+                    source VARCHAR,
+                    departement VARCHAR,
+                    periode VARCHAR,
+                    metrique VARCHAR,
+                    valeur DOUBLE,
+                    PRIMARY KEY (source, departement, periode, metrique)
+                )
+            """)
+            _connexion.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    source VARCHAR PRIMARY KEY,
+                    version INTEGER,
+                    derniere_utilisation TIMESTAMP
+                )
+            """)
+            # Niveau magasin : un comptage de clients distincts ne s'additionne pas entre départements
+            _connexion.execute("""
+                CREATE TABLE IF NOT EXISTS clients (
+                    source VARCHAR,
+                    departement VARCHAR,
+                    code_client VARCHAR
+                )
+            """)
+        return _connexion
+
+
+def normaliser_departements(departements):
+    """Règle unique de codage des départements : "1" → "01", "20" → "2A" (Corse), 2A / 2B inchangés."""
+    departements = departements.astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
+    departements = departements.replace({"20": "2A"})  # ou logique plus avancée pour distinguer 2A/2B
+    # zfill(2) laisse "2A" / "2B" intacts : pas besoin de traitement ligne à ligne
+    return departements.str.zfill(2)
+
+
+def detecter_metriques(df):
+    """Renvoie la liste (colonne, metrique, periode) des colonnes métriques présentes dans le fichier."""
+    metriques = []
+    for colonne in df.columns:
+        match = REGEX_METRIQUE.match(str(colonne).strip())
+        if match:
+            metriques.append((colonne, match["metrique"], match["periode"] or ""))
+    return metriques
+
+
+def cube_a_jour(source):
+    """Lecture seule : la source est-elle déjà ingérée avec la version courante du cube ?"""
+    res = _requete("SELECT version FROM sources WHERE source = ?", [source])
+    return not res.empty and res["version"].iloc[0] == VERSION_CUBE
+
+
+def construire_cube(df, source):
+    """Agrège les magasins par département, période et métrique (une seule fois par source et par version)."""
+    if cube_a_jour(source):
+        return
+    con = get_connexion()
+    with _verrou:
+        cur = con.cursor()
+        cur.execute("BEGIN TRANSACTION")
+        try:
+            # Une autre session a pu ingérer la source pendant l'attente du verrou
+            version = cur.execute("SELECT version FROM sources WHERE source = ?", [source]).fetchone()
+            if version is not None and version[0] == VERSION_CUBE:
+                cur.execute("COMMIT")
+                return
+
+            df = df.copy()
+            df["Departement"] = normaliser_departements(df["Departement"])
+            metriques = detecter_metriques(df)
+            long_df = df.melt(
+                id_vars=["Departement"],
+                value_vars=[colonne for colonne, _, _ in metriques],
+                var_name="colonne",
+                value_name="valeur",
+            )
+            long_df["metrique"] = long_df["colonne"].map({c: m for c, m, _ in metriques})
+            long_df["periode"] = long_df["colonne"].map({c: p for c, _, p in metriques})
+            long_df["valeur"] = pd.to_numeric(long_df["valeur"], errors="coerce")
+            cur.register("long_df", long_df[["Departement", "periode", "metrique", "valeur"]])
+            cur.register("magasins_df", df)
+
+            # Source absente ou ingérée avec une ancienne version : on repart de zéro
+            cur.execute("DELETE FROM cube WHERE source = ?", [source])
+            cur.execute("DELETE FROM clients WHERE source = ?", [source])
+            cur.execute("""
+                INSERT INTO cube
+                SELECT ?, Departement, periode, metrique, SUM(COALESCE(valeur, 0))
+                FROM long_df
+                GROUP BY Departement, periode, metrique
+            """, [source])
+            # Comptages de magasins (lignes du fichier) et de clients distincts, valables pour toutes les périodes
+            cur.execute("""
+                INSERT INTO cube
+                SELECT ?, Departement, '', 'Nb Magasins', COUNT(*)
+                FROM magasins_df
+                GROUP BY Departement
+            """, [source])
+            if "Code du client" in df.columns:
+                cur.execute("""
+                    INSERT INTO cube
+                    SELECT ?, Departement, '', 'Nb Clients', COUNT(DISTINCT "Code du client")
+                    FROM magasins_df
+                    GROUP BY Departement
+                """, [source])
+                cur.execute("""
+                    INSERT INTO clients
+                    SELECT DISTINCT ?, Departement, CAST("Code du client" AS VARCHAR)
+                    FROM magasins_df
+                    WHERE "Code du client" IS NOT NULL
+                """, [source])
+            cur.execute("""
+                INSERT OR REPLACE INTO sources VALUES (?, ?, now())
+            """, [source, VERSION_CUBE])
+
+            # Purge des sources les plus anciennes pour que la base ne grossisse pas indéfiniment
+            anciennes = cur.execute("""
+                SELECT source FROM sources ORDER BY derniere_utilisation DESC OFFSET ?
+            """, [NB_SOURCES_MAX]).fetchall()
+            for (ancienne,) in anciennes:
+                for table in ("cube", "clients", "sources"):
+                    cur.execute(f"DELETE FROM {table} WHERE source = ?", [ancienne])
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.close()
+
+
+def _requete(sql, params):
+    cur = get_connexion().cursor()
+    try:
+        return cur.execute(sql, params).df()
+    finally:
+        cur.close()
+
+
+def periodes(source, metrique="CA"):
+    """Périodes disponibles pour une métrique, de la plus ancienne à la plus récente."""
+    res = _requete(
+        "SELECT DISTINCT periode FROM cube WHERE source = ? AND metrique = ? AND periode <> '' ORDER BY periode",
+        [source, metrique],
+    )
+    return res["periode"].tolist()
+
+
+def _tranche(source, periode, departements):
+    # Pour chaque métrique on prend la valeur de la période demandée, sinon celle valable toutes périodes
+    sql = """
+        SELECT departement, metrique, valeur
+        FROM cube
+        WHERE source = ? AND periode IN (?, '')
+    """
+    params = [source, periode]
+    if departements is not None:
+        departements = list(departements)
+        if not departements:
+            return pd.DataFrame(columns=["departement", "metrique", "valeur"])
+        sql += " AND departement IN (SELECT unnest(?))"
+        params.append(departements)
+    sql += " QUALIFY ROW_NUMBER() OVER (PARTITION BY departement, metrique ORDER BY periode DESC) = 1"
+    return _requete(sql, params)
+
+
+def par_departement(source, periode, departements=None):
+    """Tableau large Departement × métriques pour une période."""
+    tranche = _tranche(source, periode, departements)
+    table = tranche.pivot(index="departement", columns="metrique", values="valeur")
+    colonnes = list(dict.fromkeys(METRIQUES + COMPTAGES + list(table.columns)))
+    table = table.reindex(columns=colonnes).fillna(0).reset_index().rename(columns={"departement": "Departement"})
+    # Les comptages sont stockés en DOUBLE dans le cube : on les rend entiers pour l'affichage
+    table[COMPTAGES] = table[COMPTAGES].astype(int)
+    table.columns.name = None
+    return table
+
+
+def clients_distincts(source, departements=None, departements_exclus=None):
+    """Nombre de clients distincts sur les départements demandés.
+
+    Les clients présents dans `departements_exclus` (par ex. déjà comptés dans une autre zone) sont ignorés.
+    """
+    sql = "SELECT COUNT(DISTINCT code_client) AS n FROM clients WHERE source = ?"
+    params = [source]
+    if departements is not None:
+        departements = list(departements)
+        if not departements:
+            return 0
+        sql += " AND departement IN (SELECT unnest(?))"
+        params.append(departements)
+    if departements_exclus:
+        sql += """
+            AND code_client NOT IN (
+                SELECT code_client FROM clients WHERE source = ? AND departement IN (SELECT unnest(?))
+            )
+        """
+        params += [source, list(departements_exclus)]
+    return int(_requete(sql, params)["n"].iloc[0])
+
+
+def totaux(source, periode, departements=None, departements_exclus=None):
+    """Somme de chaque métrique sur les départements demandés (tous si None)."""
+    tranche = _tranche(source, periode, departements)
+    resultat = tranche.groupby("metrique")["valeur"].sum().to_dict()
+    for comptage in COMPTAGES:
+        if comptage in resultat:
+            resultat[comptage] = int(resultat[comptage])
+    if "Nb Clients" in resultat:
+        resultat["Nb Clients"] = clients_distincts(source, departements, departements_exclus)
+    return resultat
+
+
+def periode_precedente(source, periode, metrique="CA"):
+    disponibles = periodes(source, metrique)
+    if periode not in disponibles or disponibles.index(periode) == 0:
+        return None
+    return disponibles[disponibles.index(periode) - 1]
+
+
+def evolution(source, metrique, periode, departements=None):
+    """Évolution en % de la métrique par rapport à la période précédente, ou None si elle n'existe pas."""
+    precedente = periode_precedente(source, periode, metrique)
+    if precedente is None:
+        return None
+    actuel = totaux(source, periode, departements).get(metrique, 0)
+    avant = totaux(source, precedente, departements).get(metrique, 0)
+    if not avant:
+        return None
+    return (actuel - avant) / avant * 100
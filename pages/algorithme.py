@@ -11,21 +11,181 @@ import numpy as np
 import math
 from shapely.geometry import Point
 import geopandas as gpd
+import hashlib
+import io
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from scipy.optimize import linear_sum_assignment
+from cube_kpi import (
+    construire_cube, detecter_metriques, evolution, normaliser_departements, par_departement, periode_precedente,
+    periodes, totaux
+)
 
 st.set_page_config(layout="wide")
 st.title("📍 Sectorisation automatique par département")
 
-# --- Chargement des données ---
-uploaded_file = st.sidebar.file_uploader("📂 Charger le fichier Excel avec les données magasins", type=["xlsx"])
-geojson_file = "geoson.geojson"  # fichier GeoJSON local des départements (code_insee)
-
-if uploaded_file is not None and geojson_file:
-    df = pd.read_excel(uploaded_file)
-    st.sidebar.success("Fichier chargé avec succès !")
-    st.sidebar.write(f"Nombre total de lignes dans le fichier brut : {len(df)}")
+# Mapping pour couleurs
+zone_colors = {
+    "Zone A": "red",
+    "Zone B": "blue",
+    "Zone C": "green",
+    "Zone D": "orange",
+    "Zone E": "violet"
+}
+
+NB_ZONES = 5
+
+
+def nom_zone(z):
+    return f"Zone {chr(65 + int(z))}" if pd.notnull(z) else "Zone ?"
+
+
+# --- Sectorisation incrémentale ---
+# Une sectorisation précédente (le CSV exporté en bas de page) sert de point de départ :
+# les départements déjà connus gardent leur zone, seuls les départements nouveaux ou voisins
+# d'un changement sont réaffectés par déplacements locaux, et les lettres de zone sont
+# alignées sur l'ancienne sectorisation pour que "Zone A" garde le même sens d'un mois à l'autre.
+NB_VOISINS_RAFFINEMENT = 5
+
+
+def lire_sectorisation_precedente(csv_bytes):
+    prec = pd.read_csv(io.BytesIO(csv_bytes), dtype={"Departement": str})
+    prec = prec.dropna(subset=["Departement", "Zone"])
+    prec["Departement"] = normaliser_departements(prec["Departement"])
+    prec["Zone"] = prec["Zone"].astype(str)
+    prec = prec[prec["Zone"].str.match(r"^Zone [A-Z]$")]
+    return dict(zip(prec["Departement"].tolist(), prec["Zone"].str[-1].map(lambda c: ord(c) - 65).tolist()))
+
+
+def aligner_labels(labels, departements, coords, precedente):
+    """Renumérote les zones pour maximiser le recouvrement avec la sectorisation précédente."""
+    if precedente:
+        recouvrement = np.zeros((NB_ZONES, NB_ZONES))
+        for label, dep in zip(labels, departements):
+            ancien = precedente.get(dep)
+            if ancien is not None and ancien < NB_ZONES:
+                recouvrement[label, ancien] += 1
+        lignes, colonnes = linear_sum_assignment(-recouvrement)
+        correspondance = dict(zip(lignes, colonnes))
+    else:
+        # Sans historique, on ordonne les zones du nord au sud pour rester déterministe
+        latitudes = [coords[labels == z, 0].mean() for z in range(NB_ZONES)]
+        correspondance = {z: rang for rang, z in enumerate(np.argsort(latitudes)[::-1])}
+    return np.array([correspondance[label] for label in labels])
+
+
+def raffiner_localement(coords, labels, candidats, max_iter=20):
+    """Déplacements locaux (Hartigan) qui réduisent l'inertie intra-zone, comme le critère de Ward."""
+    labels = labels.copy()
+    for _ in range(max_iter):
+        deplacement = False
+        for i in candidats:
+            tailles = np.bincount(labels, minlength=NB_ZONES)
+            a = labels[i]
+            if tailles[a] <= 1:
+                continue
+            centres = np.array([coords[labels == z].mean(axis=0) for z in range(NB_ZONES)])
+            distances = ((coords[i] - centres) ** 2).sum(axis=1)
+            cout_retrait = tailles[a] / (tailles[a] - 1) * distances[a]
+            couts_ajout = tailles / (tailles + 1) * distances
+            couts_ajout[a] = np.inf
+            b = int(np.argmin(couts_ajout))
+            if couts_ajout[b] < cout_retrait:
+                labels[i] = b
+                deplacement = True
+        if not deplacement:
+            break
+    return labels
+
+
+def sectorisation_incrementale(merged, centroids_df, precedente):
+    """Part de la sectorisation précédente et n'affine que là où les départements ont changé.
+
+    Renvoie None si l'historique ne couvre pas toutes les zones (on repasse alors en clustering complet).
+    """
+    coords = merged[["lat", "lon"]].to_numpy()
+    departements = merged["Departement"].tolist()
+    labels = np.array([precedente.get(dep, -1) for dep in departements])
+    connus = (labels >= 0) & (labels < NB_ZONES)
+    if len(np.unique(labels[connus])) < NB_ZONES:
+        return None
+    labels[~connus] = -1
+
+    # Les nouveaux départements rejoignent la zone connue la plus proche
+    centres = np.array([coords[labels == z].mean(axis=0) for z in range(NB_ZONES)])
+    nouveaux = np.flatnonzero(~connus)
+    for i in nouveaux:
+        labels[i] = int(np.argmin(((coords[i] - centres) ** 2).sum(axis=1)))
+
+    # Zone d'influence du changement : départements nouveaux ou disparus et leurs plus proches voisins
+    retires = centroids_df[
+        centroids_df["Departement"].isin(set(precedente) - set(departements))
+    ][["lat", "lon"]].to_numpy()
+    points_changes = np.vstack([coords[nouveaux], retires]) if len(retires) else coords[nouveaux]
+    candidats = set(nouveaux.tolist())
+    for point in points_changes:
+        distances = ((coords - point) ** 2).sum(axis=1)
+        candidats.update(np.argsort(distances)[:NB_VOISINS_RAFFINEMENT].tolist())
+
+    return raffiner_localement(coords, labels, sorted(candidats))
+
+
+# --- Exécution en arrière-plan ---
+# Le chargement, le clustering et la préparation de la carte tournent dans un pool de threads
+# partagé entre les sessions : un rerun Streamlit en cours de calcul ne perd plus le travail,
+# et un fichier déjà traité (même empreinte) est servi directement depuis le cache des jobs.
+NB_JOBS_EN_CACHE = 8
+# Une session qui n'a pas interrogé son job depuis ce délai (onglet fermé ou rechargé) ne le retient plus
+DELAI_SESSION_INACTIVE = 5
+
+
+class SectorisationAnnulee(Exception):
+    """Levée dans le worker quand l'utilisateur annule le job en cours."""
+
+
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="sectorisation")
+
+
+@st.cache_resource
+def get_jobs():
+    # job_id -> {"future", "progress", "etape", "annulation", "sessions": {session_id: dernière interrogation}}
+    return OrderedDict()
+
+
+@st.cache_resource
+def get_verrou_jobs():
+    # Le registre est partagé entre les sessions : tout accès passe par ce verrou
+    return threading.Lock()
+
+
+def empreinte_entree(file_bytes, geojson_path, precedente=None, incremental=False):
+    h = hashlib.sha256(file_bytes)
+    with open(geojson_path, "rb") as f:
+        h.update(f.read())
+    if precedente:
+        h.update(json.dumps(sorted(precedente.items())).encode("utf-8"))
+        h.update(b"incremental" if incremental else b"complet")
+    return h.hexdigest()[:16]
+
+
+def calculer_sectorisation(file_bytes, geojson_path, job, precedente=None, incremental=False):
+    def etape(progress, message):
+        if job["annulation"].is_set():
+            raise SectorisationAnnulee(message)
+        job["progress"] = progress
+        job["etape"] = message
+
+    etape(0.05, "Lecture du fichier Excel")
+    df = pd.read_excel(io.BytesIO(file_bytes))
 
     # Charger le GeoJSON
-    with open(geojson_file, encoding="utf-8") as f:
+    etape(0.25, "Chargement du GeoJSON")
+    with open(geojson_path, encoding="utf-8") as f:
         geojson_data = json.load(f)
 
     # --- Étape 1 : Convertir en GeoDataFrame
@@ -41,31 +201,28 @@ if uploaded_file is not None and geojson_file:
     # Harmoniser les formats pour la fusion (code string vs. int)
     gdf_dept["code"] = gdf_dept["code"].astype(str)
 
-    df["Departement"] = df["Departement"].astype(str).str.strip()
-
-    # Gestion spéciale Corse
-    df["Departement"] = df["Departement"].replace({"20": "2A"})  # ou logique plus avancée si tu veux distinguer 2A/2B
-    # Remplissage à gauche pour uniformiser (1 → 01, 2 → 02, etc.)
-    df["Departement"] = df["Departement"].apply(lambda x: x if x in ["2A", "2B"] else x.zfill(2))
+    etape(0.4, "Nettoyage des données")
+    # Même codage des départements que le cube KPI (Corse, remplissage 1 → 01, etc.)
+    df["Departement"] = normaliser_departements(df["Departement"])
 
 
     # --- Étape 5 : Nettoyage & suite du pipeline
-    df["Nb Visite"] = df["Nb Visite"].fillna(0)
-    df["CA 2023"] = df["CA 2023"].fillna(0)
+    for colonne, _, _ in detecter_metriques(df):
+        df[colonne] = df[colonne].fillna(0)
 
     df["Nb Magasins"] = 1
 
-    
-    # Agréger par département
-    dept_data = df.groupby("Departement").agg({
-        "Nb Magasins": "sum",
-        "Nb Visite": "sum",
-        "CA 2023": "sum"
-    }).reset_index()
+    # Agréger par département, période et métrique dans le cube KPI (une seule fois par fichier)
+    etape(0.45, "Construction du cube KPI")
+    source = hashlib.sha256(file_bytes).hexdigest()[:16]
+    construire_cube(df, source)
+    liste_periodes = periodes(source)
+
+    # Départements présents dans le fichier (les métriques sont lues dans le cube à l'affichage)
+    dept_data = pd.DataFrame({"Departement": sorted(df["Departement"].unique())})
 
     # 1. Extraire les centroïdes des départements
-    with open(geojson_file, encoding="utf-8") as f:
-        geojson_data = json.load(f)
+    etape(0.55, "Calcul des centroïdes")
     centroids = []
     codes = []
     for feature in geojson_data["features"]:
@@ -88,9 +245,16 @@ if uploaded_file is not None and geojson_file:
     merged = merged.dropna(subset=["lat", "lon"])
 
     # 4. Clustering hiérarchique basé sur la géographie
+    # (ou affinage local de la sectorisation précédente en mode incrémental)
+    etape(0.7, "Clustering des départements")
     geo_features = merged[["lat", "lon"]].to_numpy()
-    agglo = AgglomerativeClustering(n_clusters=5, linkage="ward")
-    merged["Zone"] = agglo.fit_predict(geo_features)
+    labels = None
+    if incremental and precedente:
+        labels = sectorisation_incrementale(merged, centroids_df, precedente)
+    if labels is None:
+        agglo = AgglomerativeClustering(n_clusters=NB_ZONES, linkage="ward")
+        labels = aligner_labels(agglo.fit_predict(geo_features), merged["Departement"], geo_features, precedente)
+    merged["Zone"] = labels
 
     # 5. Mise à jour des zones dans dept_data
     if "Zone" in dept_data.columns:
@@ -98,32 +262,178 @@ if uploaded_file is not None and geojson_file:
     else:
         dept_data = pd.merge(dept_data, merged[["Departement", "Zone"]], on="Departement", how="left")
 
+    dept_data["Color"] = dept_data["Zone"].map(nom_zone).map(zone_colors)
 
-    # Mapping pour couleurs
-    zone_colors = {
-        "Zone A": "red",
-        "Zone B": "blue",
-        "Zone C": "green",
-        "Zone D": "orange",
-        "Zone E": "violet"
-    }
-
-    dept_data["Color"] = dept_data["Zone"].map(zone_colors)
+    # Départements dont la zone a changé par rapport à la sectorisation précédente
+    nb_changements = 0
+    if precedente:
+        anciennes_zones = merged["Departement"].map(precedente)
+        nb_changements = int((anciennes_zones.notna() & (anciennes_zones != merged["Zone"])).sum())
 
-    # Charger le fichier GeoJSON
-    with open(geojson_file, encoding="utf-8") as f:
-        geojson_data = json.load(f)
-
-    # Ajouter les données de zone aux features du GeoJSON
+    # Ajouter les données de zone (et le CA de chaque période) aux features du GeoJSON
+    etape(0.85, "Préparation de la carte")
+    ca_par_periode = {
+        periode: par_departement(source, periode).set_index("Departement")["CA"] for periode in liste_periodes
+    }
     for feature in geojson_data["features"]:
         code_dep = str(feature["properties"]["code"]).strip()  # S'assurer que c'est une string bien formatée
         row = dept_data[dept_data["Departement"] == code_dep]
         if not row.empty:
-            feature["properties"]["Zone"] = f"Zone {chr(65 + int(row['Zone'].values[0]))}"
-            feature["properties"]["CA"] = int(row["CA 2023"].values[0])
+            feature["properties"]["Zone"] = nom_zone(row["Zone"].values[0])
         else:
             feature["properties"]["Zone"] = "Non défini"
-            feature["properties"]["CA"] = 0
+        for periode, ca in ca_par_periode.items():
+            feature["properties"][f"CA {periode}"] = int(ca.get(code_dep, 0))
+
+    etape(1.0, "Terminé")
+    return {
+        "df": df,
+        "dept_data": dept_data,
+        "geojson_data": geojson_data,
+        "nb_changements": nb_changements,
+        "source": source,
+        "periodes": liste_periodes,
+    }
+
+
+def soumettre_sectorisation(job_id, session_id, file_bytes, geojson_path, precedente=None, incremental=False):
+    jobs = get_jobs()
+    with get_verrou_jobs():
+        if job_id in jobs:
+            jobs.move_to_end(job_id)
+            jobs[job_id]["sessions"][session_id] = time.monotonic()
+            return jobs[job_id]
+
+        job = {
+            "progress": 0.0,
+            "etape": "En attente",
+            "annulation": threading.Event(),
+            "sessions": {session_id: time.monotonic()},
+        }
+        job["future"] = get_executor().submit(
+            calculer_sectorisation, file_bytes, geojson_path, job, precedente, incremental
+        )
+        jobs[job_id] = job
+
+        # On ne garde que les derniers jobs terminés en cache
+        while len(jobs) > NB_JOBS_EN_CACHE:
+            plus_ancien = next((k for k, j in jobs.items() if j["future"].done()), None)
+            if plus_ancien is None:
+                break
+            del jobs[plus_ancien]
+        return job
+
+
+def annuler_sectorisation(job_id, session_id):
+    """Détache la session du job ; le calcul n'est vraiment arrêté que si aucune autre session active ne l'attend."""
+    with get_verrou_jobs():
+        job = get_jobs().get(job_id)
+        if job is None:
+            return
+        job["sessions"].pop(session_id, None)
+        limite = time.monotonic() - DELAI_SESSION_INACTIVE
+        job["sessions"] = {s: t for s, t in job["sessions"].items() if t >= limite}
+        if not job["sessions"]:
+            job["annulation"].set()
+            job["future"].cancel()
+
+
+def oublier_sectorisation(job_id, seulement_si_annule=False):
+    with get_verrou_jobs():
+        job = get_jobs().get(job_id)
+        if job is not None and (not seulement_si_annule or job["annulation"].is_set()):
+            del get_jobs()[job_id]
+
+
+# --- Chargement des données ---
+uploaded_file = st.sidebar.file_uploader("📂 Charger le fichier Excel avec les données magasins", type=["xlsx"])
+geojson_file = "geoson.geojson"  # fichier GeoJSON local des départements (code_insee)
+
+# Sectorisation précédente (CSV exporté par cette page) pour garder des zones stables
+precedente_file = st.sidebar.file_uploader("🗂 Sectorisation précédente (CSV exporté, optionnel)", type=["csv"])
+precedente = None
+incremental = False
+if precedente_file is not None:
+    try:
+        precedente = lire_sectorisation_precedente(precedente_file.getvalue())
+    except (KeyError, ValueError, pd.errors.ParserError):
+        st.sidebar.error("Le CSV de sectorisation précédente doit contenir les colonnes `Departement` et `Zone`.")
+    else:
+        if precedente:
+            incremental = st.sidebar.checkbox(
+                "Mode incrémental (n'affiner que les départements modifiés)", value=True
+            )
+        else:
+            st.sidebar.warning("Aucune zone valide (`Zone A`, `Zone B`...) dans le CSV de sectorisation précédente.")
+
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+if "jobs_annules" not in st.session_state:
+    st.session_state["jobs_annules"] = set()
+
+if uploaded_file is not None and geojson_file:
+    file_bytes = uploaded_file.getvalue()
+    session_id = st.session_state["session_id"]
+    job_id = empreinte_entree(file_bytes, geojson_file, precedente, incremental)
+
+    # Calcul annulé par cette session (il peut continuer pour d'autres sessions sur le même fichier)
+    if job_id in st.session_state["jobs_annules"]:
+        st.warning("Le calcul de sectorisation a été annulé pour cette session.")
+        if st.button("🔁 Relancer le calcul"):
+            st.session_state["jobs_annules"].discard(job_id)
+            oublier_sectorisation(job_id, seulement_si_annule=True)
+            st.rerun()
+        st.stop()
+
+    job = soumettre_sectorisation(job_id, session_id, file_bytes, geojson_file, precedente, incremental)
+    st.sidebar.caption(f"Job de sectorisation : `{job_id}`")
+
+    # Tant que le job tourne, on affiche la progression et on relance la page pour l'interroger
+    if not job["future"].done():
+        st.progress(job["progress"], text=f"⏳ {job['etape']}...")
+        if st.sidebar.button("⛔ Annuler le calcul"):
+            annuler_sectorisation(job_id, session_id)
+            st.session_state["jobs_annules"].add(job_id)
+            st.rerun()
+        time.sleep(0.5)
+        st.rerun()
+
+    try:
+        resultat = job["future"].result()
+    except (SectorisationAnnulee, CancelledError):
+        st.warning("Le calcul de sectorisation a été annulé.")
+        if st.button("🔁 Relancer le calcul"):
+            oublier_sectorisation(job_id)
+            st.rerun()
+        st.stop()
+    except Exception as e:
+        oublier_sectorisation(job_id)
+        st.error(f"Erreur pendant la sectorisation : {e}")
+        st.stop()
+
+    # Copies pour ne pas modifier le résultat partagé en cache
+    df = resultat["df"].copy()
+    dept_data = resultat["dept_data"].copy()
+    geojson_data = resultat["geojson_data"]
+    source = resultat["source"]
+    if not resultat["periodes"]:
+        st.error("Aucune colonne de CA annuel (ex : `CA 2023`) n'a été trouvée dans le fichier.")
+        st.stop()
+    st.sidebar.success("Fichier chargé avec succès !")
+    st.sidebar.write(f"Nombre total de lignes dans le fichier brut : {len(df)}")
+    if precedente:
+        st.sidebar.info(
+            f"🔁 {resultat['nb_changements']} département(s) ont changé de zone par rapport à la sectorisation précédente."
+        )
+
+    # Période affichée : les KPI et tableaux sont des lectures du cube pour cette période
+    periode = st.sidebar.selectbox("📅 Période", resultat["periodes"], index=len(resultat["periodes"]) - 1)
+    periode_prec = periode_precedente(source, periode)
+    col_ca = f"CA {periode}"
+    dept_data = pd.merge(
+        dept_data, par_departement(source, periode).rename(columns={"CA": col_ca}), on="Departement", how="left"
+    )
+
     colA, colB = st.columns(2)
     # Partie gauche (col1)
     with colA:
@@ -152,18 +462,16 @@ if uploaded_file is not None and geojson_file:
                 # Vérifie la présence de la colonne "Région"
                 region_col = "Région" if "Région" in excluded_depts.columns else ("Region" if "Region" in excluded_depts.columns else None)
 
+                colonnes_excl = {"Nb Magasins": "sum"}
+                colonnes_excl.update({colonne: "sum" for colonne, _, _ in detecter_metriques(excluded_depts)})
                 if region_col:
-                    excl_summary = excluded_depts.groupby(["Departement", region_col]).agg({
-                        "Nb Magasins": "sum",
-                        "Nb Visite": "sum",
-                        "CA 2023": "sum"
-                    }).reset_index().sort_values(by="Nb Magasins", ascending=False)
+                    excl_summary = excluded_depts.groupby(["Departement", region_col]).agg(
+                        colonnes_excl
+                    ).reset_index().sort_values(by="Nb Magasins", ascending=False)
                 else:
-                    excl_summary = excluded_depts.groupby("Departement").agg({
-                        "Nb Magasins": "sum",
-                        "Nb Visite": "sum",
-                        "CA 2023": "sum"
-                    }).reset_index().sort_values(by="Nb Magasins", ascending=False)
+                    excl_summary = excluded_depts.groupby("Departement").agg(
+                        colonnes_excl
+                    ).reset_index().sort_values(by="Nb Magasins", ascending=False)
 
                 st.markdown("### 🧾 Détails par département non sectorisé :")
                 st.dataframe(excl_summary, use_container_width=True)
@@ -178,11 +486,21 @@ if uploaded_file is not None and geojson_file:
         # Calculs
         # nb_magasins_total = df["Code du client"].nunique()
         # nb_magasins_total = len(df)
-        nb_magasins_total = len(df_sectorised)
-        nb_visites_total = df["Nb Visite"].sum()
-        ca_total_2023 = df["CA 2023"].sum()
+        depts_sectorises = dept_data.loc[dept_data["Zone"].notna(), "Departement"]
+        nb_magasins_total = int(totaux(source, periode, depts_sectorises).get("Nb Magasins", 0))
+        totaux_periode = totaux(source, periode)
+        nb_visites_total = totaux_periode.get("Nb Visite", 0)
+        ca_total = totaux_periode.get("CA", 0)
         etp_total = round(nb_visites_total / diviseur_etp, 2)
 
+        # Comparaison avec la période précédente, si le fichier la contient
+        evolution_ca = evolution(source, "CA", periode)
+        if evolution_ca is None:
+            delta_ca = '<div class="delta">100%</div>'
+        else:
+            couleur = "green" if evolution_ca >= 0 else "red"
+            delta_ca = f'<div class="delta" style="color: {couleur};">{evolution_ca:+.1f}% vs {periode_prec}</div>'
+
         # 💅 CSS des cards
         st.markdown("""
         <style>
@@ -235,9 +553,9 @@ if uploaded_file is not None and geojson_file:
         with col3:
             st.markdown(f"""
             <div class="card">
-                <h2>{ca_total_2023:,.0f} €</h2>
-                <p>CA total 2023</p>
-                <div class="delta">100%</div>
+                <h2>{ca_total:,.0f} €</h2>
+                <p>CA total {periode}</p>
+                {delta_ca}
             </div>
             """, unsafe_allow_html=True)
 
@@ -250,35 +568,41 @@ if uploaded_file is not None and geojson_file:
             </div>
             """, unsafe_allow_html=True)
             # === Tableau 1 : Nombre de magasins et CA total par département ===
-        table1 = df.groupby("Departement").agg(
-            Nombre_Magasins=('Nb Magasins', 'sum'),
-            Total_CA_2023=('CA 2023', 'sum')
-        ).reset_index()
+        col_total_ca = f"Total_CA_{periode}"
+        table1 = dept_data[["Departement", "Nb Magasins", col_ca]].rename(
+            columns={"Nb Magasins": "Nombre_Magasins", col_ca: col_total_ca}
+        )
+        if periode_prec is not None:
+            ca_prec = par_departement(source, periode_prec).set_index("Departement")["CA"]
+            table1["Évolution CA (%)"] = (
+                (table1[col_total_ca] / table1["Departement"].map(ca_prec) - 1) * 100
+            ).replace([np.inf, -np.inf], np.nan).round(1)
 
         # st.dataframe(table1.style.format({"Total_CA_2023": "{:,.2f}"}), use_container_width=True)
         # === Tableau 2 : Synthèse par zone ===
         # Convertir code Zone en A/B/C...
-        dept_data["Nom_Zone"] = dept_data["Zone"].apply(lambda x: f"Zone {chr(65 + int(x))}" if pd.notnull(x) else "Zone ?")
-
-        # Regrouper les départements par zone
-        zone_summary = dept_data.groupby("Nom_Zone").agg({
-            "Departement": lambda x: ', '.join(sorted(x)),
-            "Nb Magasins": "sum",
-            "CA 2023": "sum",
-            "Nb Visite": "sum"
-        }).reset_index()
-
-        # Ajouter colonne ETP
-        zone_summary["ETP"] = (zone_summary["Nb Visite"] / diviseur_etp).round(2)
-
-        # Renommer les colonnes
-        zone_summary.columns = ["Zone", "Départements", "Nombre de Magasins", "Total CA (€)", "Nb Visites", "ETP"]
+        dept_data["Nom_Zone"] = dept_data["Zone"].apply(nom_zone)
+
+        # Regrouper les départements par zone (une tranche du cube par zone)
+        zone_summary = []
+        for zone_name, departements in dept_data.groupby("Nom_Zone")["Departement"]:
+            totaux_zone = totaux(source, periode, departements)
+            zone_summary.append({
+                "Zone": zone_name,
+                "Départements": ", ".join(sorted(departements)),
+                "Nombre de Magasins": int(totaux_zone.get("Nb Magasins", 0)),
+                "Total CA (€)": totaux_zone.get("CA", 0),
+                "Nb Visites": int(totaux_zone.get("Nb Visite", 0)),
+                # Ajouter colonne ETP
+                "ETP": round(totaux_zone.get("Nb Visite", 0) / diviseur_etp, 2)
+            })
+        zone_summary = pd.DataFrame(zone_summary)
 
         # Affichage
         # st.dataframe(zone_summary.style.format({"Total CA (€)": "{:,.2f}"}), use_container_width=True)
         with st.expander("📄 Détails statistiques par département et par zone", expanded=True):
             st.markdown("#### Par département")
-            st.dataframe(table1.style.format({"Total_CA_2023": lambda x: f"{x:,.0f}".replace(",", " ")}), use_container_width=True)
+            st.dataframe(table1.style.format({col_total_ca: lambda x: f"{x:,.0f}".replace(",", " ")}), use_container_width=True)
 
             st.markdown("#### Par zone")
             st.dataframe(zone_summary.style.format({
@@ -302,7 +626,7 @@ if uploaded_file is not None and geojson_file:
                 "fillOpacity": 0.6
             },
 
-            tooltip=GeoJsonTooltip(fields=["nom", "Zone", "CA"], aliases=["Département", "Zone", "CA total"])
+            tooltip=GeoJsonTooltip(fields=["nom", "Zone", col_ca], aliases=["Département", "Zone", f"CA total {periode}"])
         ).add_to(m)
 
         # Affichage dans Streamlit
@@ -311,9 +635,7 @@ if uploaded_file is not None and geojson_file:
 
         # Export CSV
         csv_export = dept_data.copy()
-        csv_export["Zone"] = csv_export["Zone"].apply(
-            lambda x: f"Zone {chr(65 + int(x))}" if pd.notnull(x) and not math.isnan(x) else "Zone ?"
-        )   
+        csv_export["Zone"] = csv_export["Zone"].apply(nom_zone)
         st.download_button("📥 Télécharger la sectorisation", data=csv_export.to_csv(index=False), file_name="sectorisation_par_departement.csv")
 
 else:
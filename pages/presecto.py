@@ -4,19 +4,36 @@ from streamlit_folium import st_folium
 import pandas as pd
 from folium.plugins import MarkerCluster, Fullscreen
 import json
+import hashlib
+import io
+from cube_kpi import (
+    construire_cube, detecter_metriques, evolution, normaliser_departements, par_departement, periode_precedente, periodes, totaux
+)
 
 st.set_page_config(page_title="Analyse Sectorielle", layout="wide")
 
 # Charger le fichier Excel
 file_path = 'Calibrage France Direct Test (1).xlsx'  
-magasins_data = pd.read_excel(file_path)
-# Corriger les départements mal codés
-magasins_data['Departement'] = magasins_data['Departement'].astype(str).str.zfill(2)
 
-# Remplacer ou corriger manuellement si besoin
-magasins_data['Departement'] = magasins_data['Departement'].replace({
-    '20': '2A',  # ou '2B' selon la logique métier, ou dupliquer si nécessaire
-    })
+@st.cache_data
+def load_magasins(path):
+    with open(path, 'rb') as file:
+        contenu = file.read()
+    magasins = pd.read_excel(io.BytesIO(contenu))
+    # Corriger les départements mal codés (même règle que le cube KPI : zfill, Corse '20' → '2A'...)
+    magasins['Departement'] = normaliser_departements(magasins['Departement'])
+    # L'empreinte du fichier identifie ses agrégats dans le cube KPI
+    return magasins, hashlib.sha256(contenu).hexdigest()[:16]
+
+# Agrégats département × période × métrique (construits une seule fois par fichier et par version du cube) :
+# les reruns suivants ne font que lire le cube
+@st.cache_resource
+def preparer_cube(source, _magasins_data):
+    construire_cube(_magasins_data, source)
+    return source
+
+magasins_data, source = load_magasins(file_path)
+preparer_cube(source, magasins_data)
 
 # Chemin local du fichier GeoJSON des départements français
 LOCAL_GEOJSON_PATH = "geoson.geojson"
@@ -103,7 +120,7 @@ zones_with_idf = {z: d for z, d in zones_with_idf.items() if z in zones_selectio
 # magasins_data_filtré = magasins_data[magasins_data['Departement'].astype(str).isin(selected_departments)]
 # # Disposition des colonnes
 # 🔁 Normaliser les formats des départements
-magasins_data['Departement'] = magasins_data['Departement'].astype(str).str.zfill(2)
+# (les départements du fichier sont déjà normalisés une fois dans load_magasins)
 selected_departments = [str(dep).zfill(2) for dep in sum(zones_with_idf.values(), [])]
 
 # 🐞 Affichage de vérification
@@ -131,19 +148,39 @@ if modifier_etp:
     diviseur_etp = st.sidebar.number_input("Valeur de référence pour le calcul ETP", value=949, step=1)
 else:
     diviseur_etp = 949  # valeur par défaut
+
+# Période affichée pour les KPI et les tableaux
+periodes_disponibles = periodes(source)
+if not periodes_disponibles:
+    st.error("Aucune colonne de CA annuel (ex : `CA 2023`) n'a été trouvée dans le fichier.")
+    st.stop()
+periode = st.sidebar.selectbox("📅 Période", periodes_disponibles, index=len(periodes_disponibles) - 1)
+periode_prec = periode_precedente(source, periode)
+# Nom réel de la colonne CA de la période dans le fichier (pour les popups des magasins)
+colonnes_ca = {p: colonne for colonne, metrique, p in detecter_metriques(magasins_data) if metrique == "CA" and p}
+col_ca = colonnes_ca[periode]
 colA, colB = st.columns(2)
 # Partie gauche (col1)
 with colA:
     st.subheader("Indicateurs Clés")
     # 💡 Calcul des indicateurs
-    nb_magasins_total = magasins_data_filtré["Code du client"].nunique()
-    nb_visites_total = magasins_data_filtré["Nb Visite"].sum()
-    ca_total_2023 = magasins_data_filtré["CA 2023"].sum()
+    totaux_selection = totaux(source, periode, selected_departments)
+    nb_magasins_total = int(totaux_selection.get("Nb Clients", 0))
+    nb_visites_total = totaux_selection.get("Nb Visite", 0)
+    ca_total = totaux_selection.get("CA", 0)
     print("Avant filtrage :", len(magasins_data))
     print("Après filtrage :", len(magasins_data_filtré))
     print("Départements filtrés :", selected_departments)
     etp_total = round(nb_visites_total / diviseur_etp, 2)  # Utiliser la valeur de référence pour ETP
 
+    # Évolution du CA par rapport à la période précédente, si elle existe dans le fichier
+    evolution_ca = evolution(source, "CA", periode, selected_departments)
+    if evolution_ca is None:
+        delta_ca = '<div class="delta positive">100%</div>'
+    else:
+        classe = "positive" if evolution_ca >= 0 else "negative"
+        delta_ca = f'<div class="delta {classe}">{evolution_ca:+.1f}% vs {periode_prec}</div>'
+
     # 💅 Style CSS pour les cards
     st.markdown("""
     <style>
@@ -212,9 +249,9 @@ with colA:
     with col3:
         st.markdown(f"""
         <div class="card">
-            <h2>{ca_total_2023:,.0f} €</h2>
-            <p>CA total</p>
-            <div class="delta positive">100%</div>
+            <h2>{ca_total:,.0f} €</h2>
+            <p>CA total {periode}</p>
+            {delta_ca}
         </div>
         """, unsafe_allow_html=True)
     with col4:
@@ -269,7 +306,7 @@ with colA:
 
             folium.Marker(
                 location=[row['lat'], row['long']],
-                popup=f"{row['Nom du client']}<br>Adresse: {row['Adresse']}<br>CA 2023: {row['CA 2023']}",
+                popup=f"{row['Nom du client']}<br>Adresse: {row['Adresse']}<br>{col_ca}: {row[col_ca]}",
                 icon=folium.Icon(color=icon_color, icon=icon_shape)
             ).add_to(marker_cluster)
 
@@ -279,11 +316,10 @@ with colA:
         st_folium(m, width=700, height=500, returned_objects=[])
         st.caption("Cette carte utilise des données GeoJSON des départements de France sectorisés.")
 
-        # Calculer le nombre de magasins et le total du CA 2023 pour chaque département
-        department_summary = magasins_data_filtré.groupby('Departement').agg(
-            Nombre_Magasins=('Nom du client', 'count'),
-            Total_CA_2023=('CA 2023', 'sum')
-        ).reset_index()
+        # Calculer le nombre de magasins et le total du CA de la période pour chaque département
+        department_summary = par_departement(source, periode, selected_departments)[
+            ['Departement', 'Nb Magasins', 'CA']
+        ].rename(columns={'Nb Magasins': 'Nombre_Magasins', 'CA': f'Total_CA_{periode}'})
 
         # Afficher le DataFrame dans Streamlit
         st.subheader("Nombre de magasins et CA total pour chaque département")
@@ -293,21 +329,20 @@ with colA:
 # Partie droite (col2)
 with colB:
     # Ajouter un tableau pour résumer les données par zone
-    codes_clients_déjà_vus = set()
+    departements_déjà_vus = set()
     zone_summary = []
 
     for zone_name, department_list in zones_with_idf.items():
-        magasins_in_zone = magasins_data_filtré[magasins_data_filtré['Departement'].astype(str).isin(department_list)]
-        
-        # Exclure les codes clients déjà comptés
-        nouveaux_magasins = magasins_in_zone[~magasins_in_zone['Code du client'].isin(codes_clients_déjà_vus)]
-        
-        total_magasins = nouveaux_magasins['Code du client'].nunique()
-        total_ca = nouveaux_magasins['CA 2023'].sum()
-        total_visites = nouveaux_magasins['Nb Visite'].sum()
+        # Exclure les départements déjà comptés (ex : 76 ou 03 présents dans deux zones)
+        nouveaux_departements = [dep for dep in department_list if dep not in departements_déjà_vus]
+        totaux_zone = totaux(source, periode, nouveaux_departements, departements_déjà_vus)
+
+        total_magasins = int(totaux_zone.get("Nb Clients", 0))
+        total_ca = totaux_zone.get("CA", 0)
+        total_visites = int(totaux_zone.get("Nb Visite", 0))
         etp = round(total_visites / diviseur_etp, 2)
 
-        codes_clients_déjà_vus.update(nouveaux_magasins['Code du client'].unique())
+        departements_déjà_vus.update(nouveaux_departements)
 
         zone_summary.append({
             "Zone": zone_name,